@@ -2,11 +2,10 @@
 Source: https://github.com/dotchen/LearningByCheating/blob/release-0.9.6/bird_view/models/common.py
 """
 
-import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 from .resnet import get_resnet
+from .spatial_softmax_kernel import spatial_softmax_expectation
 
 
 def select_branch(branches: torch.Tensor, command: torch.Tensor) -> torch.Tensor:
@@ -20,8 +19,10 @@ def select_branch(branches: torch.Tensor, command: torch.Tensor) -> torch.Tensor
     Returns:
         Tensor: Shape (B, *) for the selected branch per sample.
     """
-    command = command.long()  # Ensure command is long tensor for indexing
-    return branches[torch.arange(branches.size(0)), command]
+    # Broadcast the command to (B, 1, *) so a single gather picks the branch per sample
+    index = command.long().view(-1, 1, *([1] * (branches.dim() - 2)))
+    index = index.expand(-1, 1, *branches.shape[2:])
+    return branches.gather(1, index).squeeze(1)
 
 
 class ResnetBase(nn.Module):
@@ -50,29 +51,34 @@ class Normalize(nn.Module):
     """
     def __init__(self, mean, std):
         super().__init__()
-        self.mean = nn.Parameter(torch.FloatTensor(mean).reshape(1, 3, 1, 1), requires_grad=False)
-        self.std = nn.Parameter(torch.FloatTensor(std).reshape(1, 3, 1, 1), requires_grad=False)
+        mean = torch.as_tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        std = torch.as_tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+        # (x - mean) / std == x * scale + shift, a single fused multiply-add
+        self.register_buffer('scale', 1.0 / std)
+        self.register_buffer('shift', -mean / std)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return (x - self.mean) / self.std
+        return torch.addcmul(self.shift, x, self.scale)
 
 
 class NormalizeV2(nn.Module):
     """
     CUDA-specific version of Normalize with fixed mean and std on GPU.
+    Statistics are buffers, so they follow `model.to(device)`.
 
     Input shape: (N, C, H, W)
     Output shape: (N, C, H, W)
     """
     def __init__(self, mean, std):
         super().__init__()
-        self.mean = torch.FloatTensor(mean).reshape(1, 3, 1, 1)
-        self.std = torch.FloatTensor(std).reshape(1, 3, 1, 1)
+        mean = torch.as_tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+        std = torch.as_tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+        # (x - mean) / std == x * scale + shift, a single fused multiply-add
+        self.register_buffer('scale', 1.0 / std)
+        self.register_buffer('shift', -mean / std)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        mean = self.mean.to(x.device)
-        std = self.std.to(x.device)
-        return (x - mean) / std
+        return torch.addcmul(self.shift, x, self.scale)
 
 
 class SpatialSoftmax(nn.Module):
@@ -97,26 +103,32 @@ class SpatialSoftmax(nn.Module):
         self.width = width
         self.channel = channel
 
-        self.temperature = nn.Parameter(torch.ones(1) * temperature) if temperature else 1.0
+        # Always a tensor so forward has a single path (fixed buffer or learnable parameter)
+        if temperature is None:
+            self.register_buffer('temperature', torch.ones(1), persistent=False)
+        elif temperature > 0:
+            self.temperature = nn.Parameter(torch.tensor([float(temperature)]))
+        else:
+            raise ValueError(f"temperature must be positive or None, got {temperature}")
 
         # NOTE: x is distance ahead, y is left/right
-        pos_x, pos_y = np.meshgrid(
-            np.linspace(-1., 1., self.height),
-            np.linspace(-1., 1., self.width)
+        # x varies along the width (columns), y along the height (rows), matching the (H, W) flattening
+        pos_y, pos_x = torch.meshgrid(
+            torch.linspace(-1., 1., self.height),
+            torch.linspace(-1., 1., self.width),
+            indexing='ij'
         )
-        self.register_buffer('pos_x', torch.from_numpy(pos_x.reshape(-1)).float())
-        self.register_buffer('pos_y', torch.from_numpy(pos_y.reshape(-1)).float())
+        pos_xy = torch.stack([pos_x.reshape(-1), pos_y.reshape(-1)], dim=1)
+        self.register_buffer('pos_xy', pos_xy)  # [H*W, 2]
 
     def forward(self, feature: torch.Tensor) -> torch.Tensor:
         if self.data_format == 'NHWC':
             feature = feature.permute(0, 3, 1, 2)  # to NCHW
         N, C, H, W = feature.shape
-        feature = feature.view(N * C, H * W)
+        assert H == self.height and W == self.width, "Input size doesn't match initialized height/width"
+        feature = feature.reshape(N * C, H * W)  # reshape: input may be channels_last
 
-        weight = F.softmax(feature / self.temperature, dim=-1)
-        expected_x = torch.sum(self.pos_x * weight, dim=1, keepdim=True)
-        expected_y = torch.sum(self.pos_y * weight, dim=1, keepdim=True)
-        expected_xy = torch.cat([expected_x, expected_y], dim=1)
+        expected_xy = spatial_softmax_expectation(feature * self.temperature.reciprocal(), self.pos_xy)  # [N*C, 2]
 
         return expected_xy.view(N, C, 2)
 
@@ -154,14 +166,29 @@ class SpatialSoftmaxV2(nn.Module):
         self.x_range = x_range
         self.y_range = y_range
 
-        self.temperature = nn.Parameter(torch.ones(1) * temperature) if temperature else 1.0
-
-        pos_x, pos_y = np.meshgrid(
-            np.linspace(-1., 1., height),
-            np.linspace(-1., 1., width)
+        # Always a tensor so forward has a single path (fixed buffer or learnable parameter)
+        if temperature is None:
+            self.register_buffer('temperature', torch.ones(1), persistent=False)
+        elif temperature > 0:
+            self.temperature = nn.Parameter(torch.tensor([float(temperature)]))
+        else:
+            raise ValueError(f"temperature must be positive or None, got {temperature}")
+
+        # x varies along the width (columns), y along the height (rows), matching the (H, W) flattening
+        pos_y, pos_x = torch.meshgrid(
+            torch.linspace(-1., 1., height),
+            torch.linspace(-1., 1., width),
+            indexing='ij'
         )
-        self.register_buffer('pos_x', torch.from_numpy(pos_x.reshape(-1)).float())  # [H*W]
-        self.register_buffer('pos_y', torch.from_numpy(pos_y.reshape(-1)).float())  # [H*W]
+        pos_xy = torch.stack([pos_x.reshape(-1), pos_y.reshape(-1)], dim=1)  # [H*W, 2]
+
+        # Fold the [-1, 1] → real-world rescale into the grid: x_m = x * half_range + center
+        x_min, x_max = x_range
+        y_min, y_max = y_range
+        half_range = torch.tensor([(x_max - x_min) / 2, (y_max - y_min) / 2], dtype=torch.float32)
+        center = torch.tensor([(x_max + x_min) / 2, (y_max + y_min) / 2], dtype=torch.float32)
+        self.register_buffer('pos_xy_scaled', pos_xy * half_range)  # [H*W, 2]
+        self.register_buffer('bias', center)  # [2]
 
     def forward(self, feature: torch.Tensor) -> torch.Tensor:
         if self.data_format == 'NHWC':
@@ -169,20 +196,8 @@ class SpatialSoftmaxV2(nn.Module):
         N, C, H, W = feature.shape
         assert H == self.height and W == self.width, "Input size doesn't match initialized height/width"
 
-        feature = feature.view(N * C, H * W)  # [N*C, H*W]
-
-        weight = F.softmax(feature / self.temperature, dim=-1)  # [N*C, H*W]
-
-        # Expected (x, y) in [-1, 1]
-        expected_x = torch.sum(self.pos_x * weight, dim=1, keepdim=True)
-        expected_y = torch.sum(self.pos_y * weight, dim=1, keepdim=True)
-
-        # Scale from [-1, 1] → real-world units
-        x_min, x_max = self.x_range
-        y_min, y_max = self.y_range
-
-        x_m = ((expected_x + 1) / 2) * (x_max - x_min) + x_min
-        y_m = ((expected_y + 1) / 2) * (y_max - y_min) + y_min
+        feature = feature.reshape(N * C, H * W)  # [N*C, H*W]; reshape: input may be channels_last
 
-        expected_xy = torch.cat([x_m, y_m], dim=1)  # [N*C, 2]
+        # Fused softmax + expectation, directly in real-world units
+        expected_xy = spatial_softmax_expectation(feature * self.temperature.reciprocal(), self.pos_xy_scaled) + self.bias  # [N*C, 2]
         return expected_xy.view(N, C, 2)
@@ -0,0 +1,123 @@
+"""
+Fused softmax + expectation kernel for SpatialSoftmax.
+
+Computes, for every row of a `[R, HW]` logit matrix, the softmax-weighted
+expectation of a `[HW, 2]` coordinate grid in a single Triton program using
+the online-softmax update, so the `[R, HW]` probability matrix is never
+written to memory. Falls back to a float32 `softmax(logits) @ pos` when Triton is not
+installed, the input is not on a CUDA device, or the kernel is disabled with
+`SPATIAL_SOFTMAX_TRITON=0` (or `USE_TRITON = False` at runtime).
+
+Input:
+------
+- `logits`: Tensor of shape `[R, HW]` — temperature-scaled logits
+- `pos`: Tensor of shape `[HW, 2]` — (x, y) coordinate per spatial location
+
+Output:
+-------
+- Tensor of shape `[R, 2]` — expected (x, y) per row, in float32
+"""
+
+import os
+import torch
+import torch.nn.functional as F
+
+try:
+    import triton
+    import triton.language as tl
+    HAS_TRITON = True
+except ImportError:
+    HAS_TRITON = False
+
+# Opt-out for environments that should not JIT-compile Triton (e.g. inference machines)
+USE_TRITON = HAS_TRITON and os.environ.get("SPATIAL_SOFTMAX_TRITON", "1") != "0"
+
+
+if HAS_TRITON:
+    @triton.jit
+    def _spatial_softmax_expect_kernel(logits_ptr, pos_ptr, out_ptr, HW, stride_row, BLOCK_SIZE: tl.constexpr):
+        row = tl.program_id(0)
+        row_ptr = logits_ptr + row * stride_row
+
+        # Running max, normalizer and un-normalized x/y expectations
+        m = tl.full([1], float('-inf'), tl.float32)
+        l = tl.zeros([1], tl.float32)
+        sx = tl.zeros([1], tl.float32)
+        sy = tl.zeros([1], tl.float32)
+
+        for start in range(0, HW, BLOCK_SIZE):
+            offs = start + tl.arange(0, BLOCK_SIZE)
+            mask = offs < HW
+            v = tl.load(row_ptr + offs, mask=mask, other=float('-inf')).to(tl.float32)
+            px = tl.load(pos_ptr + offs * 2, mask=mask, other=0.)
+            py = tl.load(pos_ptr + offs * 2 + 1, mask=mask, other=0.)
+
+            m_new = tl.maximum(m, tl.max(v, axis=0))
+            alpha = tl.exp(m - m_new)
+            e = tl.exp(v - m_new)
+
+            l = l * alpha + tl.sum(e, axis=0)
+            sx = sx * alpha + tl.sum(e * px, axis=0)
+            sy = sy * alpha + tl.sum(e * py, axis=0)
+            m = m_new
+
+        zero = tl.arange(0, 1)
+        tl.store(out_ptr + row * 2 + zero, sx / l)
+        tl.store(out_ptr + row * 2 + 1 + zero, sy / l)
+
+
+class SpatialSoftmaxExpectation(torch.autograd.Function):
+    """
+    Autograd wrapper around the fused kernel.
+
+    The backward pass recomputes the softmax from the saved logits instead of
+    storing the probabilities in the forward pass.
+    """
+    @staticmethod
+    def forward(ctx, logits: torch.Tensor, pos: torch.Tensor) -> torch.Tensor:
+        logits = logits.contiguous()
+        pos = pos.contiguous().float()
+        R, HW = logits.shape
+        out = torch.empty(R, 2, device=logits.device, dtype=torch.float32)
+
+        block_size = min(triton.next_power_of_2(HW), 1024)
+        _spatial_softmax_expect_kernel[(R,)](logits, pos, out, HW, logits.stride(0), BLOCK_SIZE=block_size)
+
+        ctx.save_for_backward(logits, pos, out)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out: torch.Tensor):
+        logits, pos, out = ctx.saved_tensors
+        weight = F.softmax(logits.float(), dim=-1)                             # [R, HW]
+
+        # d E / d z_i = p_i * (pos_i - E)
+        proj = grad_out @ pos.t()                                               # [R, HW]
+        centre = (grad_out * out).sum(dim=-1, keepdim=True)                     # [R, 1]
+        grad_logits = weight * (proj - centre)
+
+        return grad_logits.to(logits.dtype), None
+
+
+def spatial_softmax_expectation(logits: torch.Tensor, pos: torch.Tensor) -> torch.Tensor:
+    """
+    Computes `softmax(logits, dim=-1) @ pos`, fused into one kernel when possible.
+
+    Args:
+        logits (Tensor): [R, HW] — temperature-scaled logits
+        pos (Tensor): [HW, 2] — coordinate grid
+
+    Returns:
+        Tensor: [R, 2] — expected (x, y) per row
+    """
+    # The kernel indexes pos by the logits' row length, so a mismatch would read out of bounds
+    if logits.dim() != 2 or pos.shape != (logits.shape[1], 2):
+        raise ValueError(f"Expected logits [R, HW] and pos [HW, 2], got {tuple(logits.shape)} and {tuple(pos.shape)}")
+
+    if USE_TRITON and logits.is_cuda:
+        return SpatialSoftmaxExpectation.apply(logits, pos)
+
+    # Keep the expectation in float32 under autocast, matching the kernel's float32 output
+    with torch.autocast(logits.device.type, enabled=False):
+        return F.softmax(logits.float(), dim=-1) @ pos.float()
+
@@ -5,8 +5,9 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import DataLoader, SubsetRandomSampler
 from models.image_net import ImagePolicyModel
+from models.network_utils import SpatialSoftmax, SpatialSoftmaxV2
 from dataloader.dataset import SampleData
 from omegaconf import DictConfig, OmegaConf
 import hydra
@@ -15,6 +16,8 @@ import wandb
 import random
 import numpy as np
 import datetime
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 # os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 
@@ -24,50 +27,145 @@ def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
-def train_epoch(loader, model, loss_fn, optimizer, device, epoch, log_to_wandb):
+def save_checkpoint(saver, model, device, path):
+    """
+    Snapshots the model weights to CPU memory and writes them to `path` on the `saver` thread,
+    so training can continue while the file is written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cpu_state = {k: v.detach().to("cpu", non_blocking=True, copy=True) for k, v in model.state_dict().items()}
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)  # make sure the non_blocking copies have landed
+    return saver.submit(torch.save, cpu_state, path)
+
+class CUDAPrefetcher:
+    """
+    Wraps a DataLoader and copies the next (obs, act) batch to the device on a side
+    CUDA stream while the current batch is being processed.
+
+    The loader should use `pin_memory=True` so the copies are truly asynchronous.
+    On a non-CUDA device batches are copied synchronously. 4D (image) tensors are
+    converted to `memory_format` as part of the copy.
+    """
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            obs, act = next(self.iter)
+        except StopIteration:
+            self.batch = None
+            return
+
+        with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+            self.batch = ([self.copy(x) for x in obs], [self.copy(x) for x in act])
+
+    def copy(self, x):
+        if x.dim() == 4:
+            return x.to(self.device, non_blocking=True, memory_format=self.memory_format)
+        return x.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+
+        if self.stream is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            # Tensors were allocated on the side stream; keep them alive until the main stream is done
+            for x in (*batch[0], *batch[1]):
+                x.record_stream(current)
+
+        self.preload()
+        return batch
+
+def train_epoch(loader, model, loss_fn, optimizer, scaler, device, epoch, log_to_wandb, amp_dtype=None, memory_format=torch.contiguous_format, log_every=50):
     model.train()
-    total_loss = 0.0
+    steps_per_epoch = len(loader)
+    base_step = epoch * steps_per_epoch
+
+    # Accumulate on device so the loop never blocks on loss.item(); the host only syncs every
+    # `log_every` steps (and on the last step) to refresh the progress bar and log to W&B
+    total_loss = torch.zeros((), device=device)
+    step_losses = torch.zeros(log_every, device=device)
 
-    loop = tqdm(loader, desc=f"Epoch {epoch+1} [Train]", leave=False)
+    loop = tqdm(CUDAPrefetcher(loader, device, memory_format), desc=f"Epoch {epoch+1} [Train]", leave=False)
     for batch_idx, (obs, act) in enumerate(loop):
-        obs = [x.to(device) for x in obs]
-        act = [x.to(device) for x in act]
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            pred = model(*obs)
+            loss = loss_fn(pred, *act)
 
-        pred = model(*obs)
-        loss = loss_fn(pred, *act)
+        # The scaler is a pass-through unless training in float16
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        loss = loss.detach()
+        total_loss += loss
+        step_losses[batch_idx % log_every] = loss
 
-        total_loss += loss.item()
-        loop.set_postfix(loss=loss.item())
+        if (batch_idx + 1) % log_every == 0:
+            loop.set_postfix(loss=(total_loss / (batch_idx + 1)).item())
+            if log_to_wandb:
+                wandb.log({"train/loss": step_losses.mean().item()}, step=base_step + batch_idx)
 
+    remainder = steps_per_epoch % log_every
+    if remainder:
+        loop.set_postfix(loss=(total_loss / steps_per_epoch).item())
         if log_to_wandb:
-            wandb.log({"train/loss": loss.item()}, step=epoch * len(loader) + batch_idx)
+            wandb.log({"train/loss": step_losses[:remainder].mean().item()}, step=base_step + steps_per_epoch - 1)
 
-    return total_loss / len(loader)
+    return (total_loss / steps_per_epoch).item()
 
-def validate_epoch(loader, model, loss_fn, device, epoch, log_to_wandb):
+def validate_epoch(loader, model, loss_fn, device, epoch, log_to_wandb, amp_dtype=None, memory_format=torch.contiguous_format, log_every=50):
     model.eval()
-    total_loss = 0.0
+    total_loss = torch.zeros((), device=device)
 
     with torch.inference_mode():
-        loop = tqdm(loader, desc=f"Epoch {epoch+1} [Val]", leave=False)
+        loop = tqdm(CUDAPrefetcher(loader, device, memory_format), desc=f"Epoch {epoch+1} [Val]", leave=False)
         for batch_idx, (obs, act) in enumerate(loop):
-            obs = [x.to(device) for x in obs]
-            act = [x.to(device) for x in act]
-
-            pred = model(*obs)
-            loss = loss_fn(pred, *act)
-            total_loss += loss.item()
-            loop.set_postfix(loss=loss.item())
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                pred = model(*obs)
+                loss = loss_fn(pred, *act)
+            total_loss += loss
+            if (batch_idx + 1) % log_every == 0 or batch_idx + 1 == len(loader):
+                loop.set_postfix(loss=(total_loss / (batch_idx + 1)).item())
 
-    return total_loss / len(loader)
+    return (total_loss / len(loader)).item()
 
 @hydra.main(config_path="../configs", config_name="train_config", version_base="1.3")
 def main(cfg: DictConfig):
     set_seed(cfg.seed)
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_saves = []
+
+    # Deterministic kernels make runs bit-reproducible but rule out the fastest cuDNN algorithms
+    if cfg.train.deterministic:
+        os.environ.setdefault("CUBLAS_WORKSPACE_CONFIG", ":4096:8")
+    torch.use_deterministic_algorithms(cfg.train.deterministic)
+    torch.backends.cudnn.deterministic = cfg.train.deterministic
+
+    # Autotuning picks the fastest conv algorithms on the first step, which only pays off
+    # when input shapes are identical across batches (fixed image size, drop_last on the train loader)
+    torch.backends.cudnn.benchmark = cfg.train.cudnn_benchmark and not cfg.train.deterministic
+    if cfg.train.tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     if cfg.wandb.log:
@@ -84,33 +182,65 @@ def main(cfg: DictConfig):
         act_keys=cfg.data.act_keys
     )
 
+    # Split by index so both loaders share the same underlying dataset instead of Subset wrappers
     val_size = int(len(dataset) * cfg.data.val_ratio)
-    train_size = len(dataset) - val_size
-    train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
+    perm = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(cfg.seed)).tolist()
+    train_idx, val_idx = perm[val_size:], perm[:val_size]
 
-    train_loader = DataLoader(train_dataset, batch_size=cfg.data.batch_size, shuffle=True,
-                              num_workers=cfg.data.num_workers, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=cfg.data.batch_size, shuffle=False,
-                            num_workers=cfg.data.num_workers, pin_memory=True)
+    # Keep workers alive across epochs with a deeper prefetch queue (prefetch_factor needs num_workers > 0)
+    loader_kwargs = dict(
+        batch_size=cfg.data.batch_size,
+        num_workers=cfg.data.num_workers,
+        pin_memory=True,
+        persistent_workers=cfg.data.num_workers > 0,
+        prefetch_factor=cfg.data.prefetch_factor if cfg.data.num_workers > 0 else None
+    )
+    # drop_last keeps batch shapes static for cudnn.benchmark and torch.compile
+    train_loader = DataLoader(dataset, sampler=SubsetRandomSampler(train_idx), drop_last=True, **loader_kwargs)
+    val_loader = DataLoader(dataset, sampler=SubsetRandomSampler(val_idx), **loader_kwargs)
 
     model = ImagePolicyModel(backbone=cfg.model.backbone, pretrained=cfg.model.pretrained, steps=cfg.model.steps, commands=cfg.model.commands).to(device)
+    # NHWC lets cuDNN pick tensor-core conv kernels; inputs are converted by the prefetcher
+    memory_format = torch.channels_last if cfg.train.channels_last else torch.contiguous_format
+    model = model.to(memory_format=memory_format)
     if cfg.train.use_compile:
         model = torch.compile(model)
+    elif cfg.train.compile_softmax:
+        # Shapes are fixed at construction, so specialize each head; the model is already on device
+        for module in model.modules():
+            if isinstance(module, (SpatialSoftmax, SpatialSoftmaxV2)):
+                module.compile(dynamic=False, mode="reduce-overhead")
 
     loss_fn = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters(), lr=cfg.train.lr)
+    # Fused Adam updates all parameters in a single CUDA kernel; foreach is the multi-tensor fallback
+    if device.type == "cuda":
+        optimizer = optim.Adam(model.parameters(), lr=cfg.train.lr, fused=True)
+    else:
+        optimizer = optim.Adam(model.parameters(), lr=cfg.train.lr, foreach=True)
+
+    # Mixed precision is CUDA-only; bfloat16 needs no loss scaling, float16 does
+    amp_dtypes = {"bfloat16": torch.bfloat16, "float16": torch.float16}
+    if cfg.train.amp_dtype not in amp_dtypes:
+        raise ValueError(f"train.amp_dtype must be one of {list(amp_dtypes)}, got {cfg.train.amp_dtype!r}")
+    amp_dtype = amp_dtypes[cfg.train.amp_dtype] if cfg.train.amp and device.type == "cuda" else None
+    if amp_dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported(including_emulation=False):
+        print("bfloat16 is not natively supported on this GPU, using float16 with loss scaling instead.")
+        amp_dtype = torch.float16
+    scaler = torch.amp.GradScaler("cuda", enabled=amp_dtype == torch.float16)
 
     for epoch in range(cfg.train.epochs):
         print(f"\n Epoch {epoch+1}/{cfg.train.epochs}")
-        train_loss = train_epoch(train_loader, model, loss_fn, optimizer, device, epoch, cfg.wandb.log)
-        val_loss = validate_epoch(val_loader, model, loss_fn, device, epoch, cfg.wandb.log)
+        train_loss = train_epoch(train_loader, model, loss_fn, optimizer, scaler, device, epoch, cfg.wandb.log,
+                                 amp_dtype, memory_format, cfg.train.log_every)
+        val_loss = validate_epoch(val_loader, model, loss_fn, device, epoch, cfg.wandb.log,
+                                  amp_dtype, memory_format, cfg.train.log_every)
 
         print(f" Train Loss: {train_loss:.6f} | Val Loss: {val_loss:.6f}")
 
         if cfg.train.epoch_save:
-            os.makedirs(os.path.dirname(f'checkpoints/{datetime.datetime.now().strftime("%m%d_%H%M")}_epoch{epoch+1}.pth'), exist_ok=True)
-            torch.save(model.state_dict(), f'checkpoints/{datetime.datetime.now().strftime("%m%d_%H%M")}_epoch{epoch+1}.pth')
-            print(f"\nCheckpoint saved successfully.")
+            timestamp = datetime.datetime.now().strftime("%m%d_%H%M")
+            pending_saves.append(save_checkpoint(saver, model, device, f'checkpoints/{timestamp}_epoch{epoch+1}.pth'))
+            print(f"\nCheckpoint queued for saving.")
 
         if cfg.wandb.log:
             wandb.log({
@@ -122,8 +252,13 @@ def main(cfg: DictConfig):
     print("Training complete.")
 
     if cfg.train.save:
-        os.makedirs(os.path.dirname(f'checkpoints/{datetime.datetime.now().strftime("%m%d_%H%M")}_model.pth'), exist_ok=True)
-        torch.save(model.state_dict(), f'checkpoints/{datetime.datetime.now().strftime("%m%d_%H%M")}_model.pth')
+        timestamp = datetime.datetime.now().strftime("%m%d_%H%M")
+        pending_saves.append(save_checkpoint(saver, model, device, f'checkpoints/{timestamp}_model.pth'))
+
+    saver.shutdown(wait=True)
+    for future in pending_saves:
+        future.result()  # re-raises any error from the background torch.save
+    if cfg.train.save:
         print(f"\nModel saved successfully.")
 
     if cfg.wandb.log:
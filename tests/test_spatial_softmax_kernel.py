@@ -0,0 +1,53 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.nn.functional as F
+from models import spatial_softmax_kernel
+from models.spatial_softmax_kernel import spatial_softmax_expectation
+
+SHAPES = [(8, 48, 48), (5, 7, 13), (3, 1, 1)]  # tiled, non-square/non-power-of-two, single cell
+
+
+def reference_expectation(logits, pos, grad_out):
+    """Float64 PyTorch reference for the forward value and the gradient w.r.t. logits."""
+    expected = F.softmax(logits.double(), dim=-1) @ pos.double()
+    (grad,) = torch.autograd.grad(expected, logits, grad_out.double())
+    return expected.float(), grad
+
+
+def check_parity(device, rows, height, width):
+    torch.manual_seed(0)
+    logits = (3 * torch.randn(rows, height * width, device=device)).requires_grad_()
+    pos = torch.randn(height * width, 2, device=device)
+    grad_out = torch.randn(rows, 2, device=device)
+
+    out = spatial_softmax_expectation(logits, pos)
+    (grad,) = torch.autograd.grad(out, logits, grad_out)
+    expected, expected_grad = reference_expectation(logits, pos, grad_out)
+
+    assert out.dtype == torch.float32
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(grad, expected_grad, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("rows, height, width", SHAPES)
+def test_eager_path_matches_reference(monkeypatch, rows, height, width):
+    monkeypatch.setattr(spatial_softmax_kernel, "USE_TRITON", False)
+    check_parity("cpu", rows, height, width)
+
+
+@pytest.mark.skipif(not (spatial_softmax_kernel.HAS_TRITON and torch.cuda.is_available()),
+                    reason="needs Triton and a CUDA device")
+@pytest.mark.parametrize("rows, height, width", SHAPES)
+def test_triton_kernel_matches_reference(monkeypatch, rows, height, width):
+    monkeypatch.setattr(spatial_softmax_kernel, "USE_TRITON", True)
+    check_parity("cuda", rows, height, width)
+
+
+def test_mismatched_grid_raises():
+    with pytest.raises(ValueError):
+        spatial_softmax_expectation(torch.randn(4, 48 * 48), torch.randn(32 * 32, 2))